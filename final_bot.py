@@ -5,76 +5,263 @@
 import os
 import logging
 import asyncio
-import aiohttp
+import httpx
 import json
-from typing import Dict, Any, Optional, List
+import re
+import hashlib
+import hmac
+import time
+import weakref
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, List, AsyncIterator, Deque, NamedTuple
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-from datetime import datetime
+from telegram.error import BadRequest, RetryAfter, TelegramError
+from telegram.ext import AIORateLimiter, Application, CommandHandler, MessageHandler, filters, ContextTypes
+from functools import lru_cache
+from collections import OrderedDict, deque
+from itertools import chain, islice
 from dotenv import load_dotenv
 
+try:
+    import tiktoken  # Optional: exact token counts for the history budget
+except ImportError:
+    tiktoken = None
+
+try:
+    import orjson  # Optional: faster JSON encoding and decoding
+except ImportError:
+    orjson = None
+
+try:
+    import h2  # noqa: F401  Optional: enables HTTP/2 in httpx ("httpx[http2]")
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+try:
+    import aiolimiter  # noqa: F401  Optional: enables AIORateLimiter ("python-telegram-bot[rate-limiter]")
+    RATE_LIMITER_AVAILABLE = True
+except ImportError:
+    RATE_LIMITER_AVAILABLE = False
+
+try:
+    import uvloop  # Optional: libuv-based event loop (not available on Windows)
+except ImportError:
+    uvloop = None
+
+if orjson is not None:
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+else:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj: Any) -> bytes:
+        return json.dumps(obj).encode()
+
 load_dotenv()
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+OPENAI_API_BASE = "https://api.openai.com"
+OPENAI_CHAT_URL = f"{OPENAI_API_BASE}/v1/chat/completions"
+OPENAI_RESPONSES_URL = f"{OPENAI_API_BASE}/v1/responses"
+TYPING_DELAY = 0.3  # Seconds to wait for a reply before showing "typing..."
+FINAL_EDIT_ATTEMPTS = 3  # Tries for the edit that completes a streamed reply
+STREAM_EDIT_INTERVAL = 1.0  # Seconds between Telegram message edits while streaming (~1 edit/s per chat limit)
+HISTORY_LIMIT = 10  # Exchanges remembered per user
+MAX_USERS = 10000  # Users whose history/session is kept; least recently active are evicted
+SESSION_TTL = 24 * 3600  # Seconds of inactivity after which a user's session and history are dropped
+HISTORY_TOKEN_BUDGET = 1500  # Max prompt tokens spent on past exchanges
+HISTORY_VERBATIM_TURNS = 3  # Recent exchanges sent word for word; older ones are summarized
+SUMMARY_MAX_TOKENS = 60  # Length of the rolling summary of older exchanges
+SUMMARY_BATCH = 3  # Older exchanges folded into the summary per summarization call
+RESPONSE_CACHE_SIZE = 2048  # Cached replies shared across all users
+RESPONSE_CACHE_MAX_HISTORY = 3  # Only cache while the conversation is this short
+RESPONSE_CACHE_MAX_MESSAGE_LENGTH = 200  # Longer messages are unlikely to repeat verbatim
+QUICK_REPLY_MAX_LENGTH = 40  # Short greetings/thanks/goodbyes are answered locally
+
+# Static prompt and command texts, built once at import time. The system
+# message never changes so every request shares the same cacheable prefix;
+# per-turn instructions go into the final user message instead.
+ASSISTANT_INSTRUCTIONS = "You are a helpful AI assistant in a Telegram bot. Be friendly, concise, and helpful. Keep responses under 200 words unless specifically asked for more detail."
+SYSTEM_MESSAGE = {"role": "system", "content": ASSISTANT_INSTRUCTIONS}  # Shared by reference, never mutated
+SUMMARY_MESSAGE = {
+    "role": "system",
+    "content": "Summarize the conversation below in at most three short sentences, keeping names, facts and open questions the assistant may need later. Reply with the summary only."
+}
+
+WELCOME_MESSAGE = """🤖 **AI Agent Bot**
+
+Hello {user_name}! I'm your AI assistant. I can help you with:
+
+✨ **Natural Conversation** - Just talk to me!
+🤔 **Questions & Answers** - Ask me anything
+🛠️ **General Assistance** - I'm here to help
+
+Just send me a message and I'll respond naturally.
+
+Type /help for more commands."""
+
+HELP_TEXT = """🆘 **Available Commands:**
+
+🤖 **Natural Chat** - Just type any message!
+• Ask questions, request help, or chat casually
+• I'll understand context from our conversation
+
+📝 **Commands:**
+• `/start` - Initialize the bot
+• `/help` - Show this help message  
+• `/clear` - Clear conversation history
+• `/status` - Show your session info
+
+💡 **Examples:**
+• "What's the weather like?"
+• "Help me write an email"
+• "Tell me a joke"
+• "Explain quantum physics simply"
+
+Just type naturally - I'm designed to understand and help! 🚀"""
+
+# Keyword sets for the local analysis and fallback replies: single words are
+# matched against the message's tokens, multi-word phrases as substrings
+_WORD_RE = re.compile(r"[\w']+")
+_GREETING_WORDS = frozenset({"hello", "hi", "hey"})
+_GREETING_PHRASES = ("good morning", "good evening")
+_HELP_WORDS = frozenset({"help", "explain"})
+_HELP_PHRASES = ("how to", "what is")
+_REQUEST_WORDS = frozenset({"please"})
+_REQUEST_PHRASES = ("can you", "could you", "would you")
+_POSITIVE_WORDS = frozenset({"great", "good", "excellent", "love", "amazing", "happy"})
+_NEGATIVE_WORDS = frozenset({"bad", "terrible", "awful", "hate", "angry", "frustrated"})
+
+_THANKS_WORDS = frozenset({"thanks"})
+_THANKS_PHRASES = ("thank you",)
+_BYE_WORDS = frozenset({"bye", "goodbye"})
+_BYE_PHRASES = ("see you",)
+
+# A message made only of these words is pure small talk and gets a quick local reply
+_SMALL_TALK_FILLER = frozenset({"ok", "okay", "oh", "so", "much", "very", "a", "lot", "there", "again", "all", "everyone", "bot", "later", "for", "now"})
+_SMALL_TALK_WORDS = (
+    _GREETING_WORDS | _THANKS_WORDS | _BYE_WORDS | _SMALL_TALK_FILLER
+    | frozenset(word for phrase in _THANKS_PHRASES + _BYE_PHRASES for word in phrase.split())
+)
+
+# Generic replies used when no keyword matches
+_FALLBACK_REPLIES = (
+    "I understand. How can I help you with that?",
+    "That's interesting! Tell me more.",
+    "I'm here to help. What would you like to know?",
+    "Thanks for sharing that with me.",
+    "I see. Is there anything specific you'd like assistance with?"
+)
+
+@dataclass
+class Session:
+    """Per-user session statistics shown by /status"""
+    __slots__ = ("started_at", "message_count", "name", "last_seen")
+    started_at: float  # time.monotonic() when the session began
+    message_count: int
+    name: str
+    last_seen: float  # time.monotonic() of the user's latest message
+
+class HistoryEntry(NamedTuple):
+    """One user/bot exchange kept for conversation context"""
+    user: str
+    bot: str
+    tokens: int
+    local: bool = False  # Answered without the model (quick reply or cache hit)
+
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """Load the tokenizer once, or return None to fall back to estimates"""
+    if tiktoken is None:
+        return None
+    try:
+        return tiktoken.encoding_for_model("gpt-3.5-turbo")
+    except Exception as e:
+        logger.warning("tiktoken unavailable, estimating token counts: %s", e)
+        return None
+
+def count_tokens(text: str) -> int:
+    """Count tokens in text, assuming ~4 characters per token without tiktoken"""
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text))
+
 class LLMProcessor:
     """Handles AI language model interactions for natural conversation"""
     
     def __init__(self, api_key: str = None):
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         self.enabled = bool(self.api_key)
-        self.conversation_history = {}  # Store conversation context per user
-        
-    async def analyze_intent(self, message: str) -> Dict[str, Any]:
-        """Analyze user message intent and sentiment"""
+        # Opt-in: let OpenAI keep the conversation state (Responses API) instead of resending history
+        self.use_responses_api = os.getenv("USE_RESPONSES_API") == "1"
+        # Conversation context per user, in least-recently-active order
+        self.conversation_history: "OrderedDict[int, Deque[HistoryEntry]]" = OrderedDict()
+        self._response_cache: "OrderedDict[bytes, str]" = OrderedDict()  # LRU of recent replies
+        # Rolling per-user summaries of exchanges older than the verbatim window,
+        # updated in the background by one task per user
+        self._summaries: Dict[int, str] = {}
+        self._pending_summary: Dict[int, List[HistoryEntry]] = {}
+        self._summary_tasks: Dict[int, asyncio.Task] = {}
+        self._response_ids: Dict[int, str] = {}  # Last stored Responses API reply per user
+        # Secret for the user tags sent to OpenAI; a random one still hides ids, but
+        # changes on every restart
+        tag_secret = os.getenv("USER_TAG_SECRET") or os.getenv("TELEGRAM_BOT_TOKEN")
+        self._user_tag_key = tag_secret.encode() if tag_secret else os.urandom(32)
+        self.headers = {
+            "Authorization": f"Bearer {self.api_key}", 
+            "Content-Type": "application/json"
+        }
+        # Shared HTTP client, created lazily inside the running event loop
+        self._client: Optional[httpx.AsyncClient] = None
+    
+    def _get_client(self) -> httpx.AsyncClient:
+        """Return the shared keep-alive client, creating it on first use"""
+        if self._client is None or self._client.is_closed:
+            # HTTP/2 multiplexes concurrent requests over one TLS connection
+            self._client = httpx.AsyncClient(
+                headers=self.headers,  # Auth headers set once for every request
+                http2=HTTP2_AVAILABLE,
+                timeout=httpx.Timeout(30.0),
+                limits=httpx.Limits(
+                    max_connections=100,
+                    max_keepalive_connections=20,
+                    keepalive_expiry=75
+                )
+            )
+        return self._client
+    
+    async def close(self):
+        """Stop background summaries and close the shared HTTP client"""
+        for task in self._summary_tasks.values():
+            task.cancel()
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
+    async def warmup(self):
+        """Open a TLS connection to OpenAI ahead of the first user message"""
         if not self.enabled:
-            return self._fallback_analysis(message)
-        
+            return
         try:
-            timeout = aiohttp.ClientTimeout(total=10)  # Add timeout
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                payload = {
-                    "model": "gpt-3.5-turbo",
-                    "messages": [{
-                        "role": "user", 
-                        "content": f'Analyze this message and return JSON with intent classification: "{message}"\n\nReturn: {{"intent": "question|request|greeting|chitchat|help", "sentiment": "positive|neutral|negative", "topic": "general|technical|personal|other"}}'
-                    }],
-                    "max_tokens": 100,
-                    "temperature": 0.1
-                }
-                headers = {
-                    "Authorization": f"Bearer {self.api_key}", 
-                    "Content-Type": "application/json"
-                }
-                
-                async with session.post("https://api.openai.com/v1/chat/completions", 
-                                       headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        content = result['choices'][0]['message']['content'].strip()
-                        content = content.replace("```json", "").replace("```", "").strip()
-                        return json.loads(content)
-                    else:
-                        logger.warning(f"OpenAI API error: {response.status}")
-        except asyncio.TimeoutError:
-            logger.warning("LLM analysis timed out")
-        except json.JSONDecodeError as e:
-            logger.warning(f"JSON decode error in LLM analysis: {e}")
+            await self._get_client().head(OPENAI_API_BASE, timeout=3.0)
+            logger.info("🔌 OpenAI connection pool warmed up")
         except Exception as e:
-            logger.warning(f"LLM analysis failed: {e}")
-        
-        return self._fallback_analysis(message)
+            logger.debug("OpenAI warmup skipped: %s", e)
     
-    def _fallback_analysis(self, message: str) -> Dict[str, Any]:
-        """Simple keyword-based analysis when LLM is unavailable"""
+    def _local_analysis(self, message: str) -> Dict[str, Any]:
+        """Keyword-based intent and sentiment analysis that needs no API call"""
         m = message.lower()
+        tokens = set(_WORD_RE.findall(m))
         
         # Intent detection
-        if any(word in m for word in ["hello", "hi", "hey", "good morning", "good evening"]):
+        if tokens & _GREETING_WORDS or any(p in m for p in _GREETING_PHRASES):
             intent = "greeting"
-        elif any(word in m for word in ["help", "how to", "what is", "explain"]):
+        elif tokens & _HELP_WORDS or any(p in m for p in _HELP_PHRASES):
             intent = "help"
-        elif any(word in m for word in ["please", "can you", "could you", "would you"]):
+        elif tokens & _REQUEST_WORDS or any(p in m for p in _REQUEST_PHRASES):
             intent = "request"
         elif "?" in message:
             intent = "question"
@@ -82,9 +269,9 @@ class LLMProcessor:
             intent = "chitchat"
         
         # Sentiment detection
-        if any(word in m for word in ["great", "good", "excellent", "love", "amazing", "happy"]):
+        if tokens & _POSITIVE_WORDS:
             sentiment = "positive"
-        elif any(word in m for word in ["bad", "terrible", "awful", "hate", "angry", "frustrated"]):
+        elif tokens & _NEGATIVE_WORDS:
             sentiment = "negative"
         else:
             sentiment = "neutral"
@@ -95,183 +282,420 @@ class LLMProcessor:
             "topic": "general"
         }
     
-    async def generate_response(self, user_id: str, message: str, context: str = "") -> str:
-        """Generate contextual response using LLM"""
+    async def analyze_and_stream(self, user_id: int, message: str) -> AsyncIterator[str]:
+        """Classify the message locally and stream the reply from a single LLM call"""
         if not self.enabled:
-            return self._fallback_response(message)
+            yield self._fallback_response(message)
+            return
+        
+        # Trivial messages don't need a round trip at all
+        quick = self.quick_reply(message)
+        if quick is not None:
+            self._update_history(user_id, message, quick, local=True)
+            yield quick
+            return
+        
+        # Classify locally; the labels travel to the model as context
+        analysis = self._local_analysis(message)
         
         # Get conversation history
-        history = self.conversation_history.get(user_id, [])
+        history = self._get_history(user_id)
+        reply = ""
+        
+        # Serve repeated prompts without a round trip. Not with server-side
+        # state, where a cached answer to a real question would be missing from
+        # the thread (quick replies are pure small talk the thread can do without)
+        cache_key = None if self.use_responses_api else self._cache_key(history, message)
+        cached = self._cache_get(cache_key)
+        if cached is not None:
+            self._update_history(user_id, message, cached, local=True)
+            yield cached
+            return
         
         try:
-            timeout = aiohttp.ClientTimeout(total=15)  # Add timeout
-            async with aiohttp.ClientSession(timeout=timeout) as session:
-                # Build conversation context
-                messages = [
-                    {"role": "system", "content": "You are a helpful AI assistant in a Telegram bot. Be friendly, concise, and helpful. Keep responses under 200 words unless specifically asked for more detail."}
-                ]
-                
-                # Add recent conversation history (last 5 exchanges)
-                for hist in history[-5:]:
-                    messages.append({"role": "user", "content": hist["user"]})
-                    messages.append({"role": "assistant", "content": hist["bot"]})
-                
-                # Add current message
-                if context:
-                    messages.append({"role": "user", "content": f"Context: {context}\nUser message: {message}"})
-                else:
-                    messages.append({"role": "user", "content": message})
-                
+            # Only the final message varies between requests
+            context = f"Intent: {analysis['intent']}, Sentiment: {analysis['sentiment']}"
+            user_content = f"Context: {context}\nUser message: {message}"
+            
+            if self.use_responses_api:
+                # OpenAI already holds the earlier turns; send just the new message
+                url = OPENAI_RESPONSES_URL
                 payload = {
                     "model": "gpt-3.5-turbo",
-                    "messages": messages,
-                    "max_tokens": 300,
-                    "temperature": 0.7
+                    "instructions": ASSISTANT_INSTRUCTIONS,
+                    "input": user_content,
+                    "max_output_tokens": 350,
+                    "temperature": 0.7,
+                    "stream": True,
+                    "truncation": "auto",  # Drop the oldest stored turns instead of overflowing the context
+                    "user": self._user_tag(user_id)
                 }
-                headers = {
-                    "Authorization": f"Bearer {self.api_key}", 
-                    "Content-Type": "application/json"
+                previous_id = self._response_ids.get(user_id)
+                if previous_id:
+                    payload["previous_response_id"] = previous_id
+            else:
+                # Build conversation context from the shared system prompt and
+                # the recent conversation history that fits the token budget
+                messages = self._context_messages(user_id, history)
+                messages.append({"role": "user", "content": user_content})
+                url = OPENAI_CHAT_URL
+                payload = {
+                    "model": "gpt-3.5-turbo",
+                    "messages": messages,
+                    "max_tokens": 350,
+                    "temperature": 0.7,
+                    "stream": True,
+                    "user": self._user_tag(user_id)
                 }
-                
-                async with session.post("https://api.openai.com/v1/chat/completions", 
-                                       headers=headers, json=payload) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        bot_response = result['choices'][0]['message']['content'].strip()
+            timeout = httpx.Timeout(30.0, read=15.0)  # Add timeout
+            
+            async with self._get_client().stream("POST", url, content=_json_dumps(payload),
+                                                 timeout=timeout) as response:
+                if response.status_code == 200:
+                    response_id = None
+                    
+                    # Server-sent events: one "data: {...}" line per token chunk
+                    async for line in response.aiter_lines():
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[5:].strip()
+                        if data == "[DONE]":
+                            # Keep reading to the end of the body so the connection can be reused
+                            continue
+                        event = _json_loads(data)
+                        if self.use_responses_api:
+                            # Typed events; only text deltas and the final id matter here
+                            event_type = event.get('type')
+                            if event_type == 'response.completed':
+                                response_id = event['response']['id']
+                                continue
+                            if event_type in ('error', 'response.failed'):
+                                # Start a fresh chain next turn rather than failing on the same thread
+                                error = event.get('error') or event.get('response', {}).get('error')
+                                logger.warning("OpenAI response failed: %s", error)
+                                self._response_ids.pop(user_id, None)
+                                response_id = None
+                                continue
+                            if event_type != 'response.output_text.delta':
+                                continue
+                            delta = event.get('delta')
+                        else:
+                            delta = event['choices'][0]['delta'].get('content')
+                        if not delta:
+                            continue
                         
+                        if not reply:
+                            # Don't open the Telegram message with blank space
+                            delta = delta.lstrip()
+                            if not delta:
+                                continue
+                        
+                        reply += delta
+                        yield delta
+                    
+                    reply = reply.strip()
+                    if reply:
                         # Update conversation history
-                        self._update_history(user_id, message, bot_response)
-                        return bot_response
-                    else:
-                        logger.warning(f"OpenAI API error: {response.status} - {await response.text()}")
-        except asyncio.TimeoutError:
-            logger.warning("LLM response generation timed out")
+                        if response_id:
+                            self._response_ids[user_id] = response_id
+                        self._cache_put(cache_key, reply)
+                        self._update_history(user_id, message, reply)
+                        return
+                    logger.warning("LLM returned an empty reply")
+                else:
+                    if self.use_responses_api:
+                        # The stored thread may be expired, deleted or too long; don't reuse it
+                        self._response_ids.pop(user_id, None)
+                    # Only drain the error body when the warning will actually be emitted
+                    if logger.isEnabledFor(logging.WARNING):
+                        await response.aread()
+                        logger.warning("OpenAI API error: %s - %s", response.status_code, response.text)
+        except httpx.TimeoutException:
+            logger.warning("LLM response streaming timed out")
         except Exception as e:
-            logger.warning(f"LLM response generation failed: {e}")
+            logger.warning("LLM response streaming failed: %s", e)
         
-        return self._fallback_response(message)
+        # Only fall back if the user has not seen any part of a reply yet
+        if not reply:
+            yield self._fallback_response(message)
     
-    def _update_history(self, user_id: str, user_message: str, bot_response: str):
-        """Update conversation history for context"""
-        if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = []
+    def _user_tag(self, user_id: int) -> str:
+        """Keyed id for OpenAI's user field, which also keeps prompt-cache routing sticky"""
+        # A plain hash of a ~10-digit id is trivially brute-forced, so key it with a secret
+        return hmac.new(self._user_tag_key, str(user_id).encode(), hashlib.sha256).hexdigest()[:32]
+    
+    def _context_messages(self, user_id: int, history: Deque[HistoryEntry]) -> List[Dict[str, str]]:
+        """System prompt, then the summary of older exchanges (if any) and the recent ones"""
+        messages = [SYSTEM_MESSAGE]
+        summary = self._summaries.get(user_id)
+        if summary:
+            messages.append({"role": "system", "content": f"Summary of the earlier conversation: {summary}"})
+        # Exchanges waiting for the next summary batch are still sent word for word
+        self._append_history(messages, history, self._pending_summary.get(user_id, ()))
+        return messages
+    
+    @staticmethod
+    def _append_history(messages: List[Dict[str, str]], history: Deque[HistoryEntry],
+                        pending: List[HistoryEntry] = ()):
+        """Append the not-yet-summarized and newest HISTORY_VERBATIM_TURNS exchanges that fit HISTORY_TOKEN_BUDGET"""
+        selected = []
+        used = 0
+        for hist in chain(islice(reversed(history), HISTORY_VERBATIM_TURNS), reversed(pending)):
+            used += hist.tokens
+            if used > HISTORY_TOKEN_BUDGET:
+                break
+            selected.append(hist)
         
-        self.conversation_history[user_id].append({
-            "user": user_message,
-            "bot": bot_response,
-            "timestamp": datetime.now().isoformat()
-        })
+        for user_text, bot_text, _, _ in reversed(selected):
+            messages.append({"role": "user", "content": user_text})
+            messages.append({"role": "assistant", "content": bot_text})
+    
+    @staticmethod
+    def _cache_key(history: Deque[HistoryEntry], message: str) -> Optional[bytes]:
+        """Key a reply by recent user turns and the normalized message; None when not cacheable"""
+        if len(history) > RESPONSE_CACHE_MAX_HISTORY or len(message) > RESPONSE_CACHE_MAX_MESSAGE_LENGTH:
+            # Longer conversations and messages rarely repeat exactly and risk stale hits
+            return None
+        parts = [hist.user for hist in history]
+        parts.append(message.strip().lower())
+        # The cache is shared between users, so use a real digest rather than hash()
+        return hashlib.blake2b("\x1f".join(parts).encode(), digest_size=16).digest()
+    
+    def _cache_get(self, key: Optional[bytes]) -> Optional[str]:
+        """Return a cached reply and mark it as recently used"""
+        if key is None:
+            return None
+        reply = self._response_cache.get(key)
+        if reply is not None:
+            self._response_cache.move_to_end(key)
+        return reply
+    
+    def _cache_put(self, key: Optional[bytes], reply: str):
+        """Store a reply, evicting the least recently used entry when full"""
+        if key is None:
+            return
+        self._response_cache[key] = reply
+        self._response_cache.move_to_end(key)
+        if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+            self._response_cache.popitem(last=False)
+    
+    def _get_history(self, user_id: int) -> Deque[HistoryEntry]:
+        """Return the user's history (empty if none), marking them as recently active"""
+        history = self.conversation_history.get(user_id)
+        if history is None:
+            return ()
+        self.conversation_history.move_to_end(user_id)
+        return history
+    
+    def _update_history(self, user_id: int, user_message: str, bot_response: str, local: bool = False):
+        """Update conversation history for context"""
+        # Bounded deque keeps only the last HISTORY_LIMIT exchanges to manage memory;
+        # appending evicts the oldest entry, so no separate trim step is required
+        history = self.conversation_history.get(user_id)
+        if history is None:
+            history = self.conversation_history[user_id] = deque(maxlen=HISTORY_LIMIT)
+            # Forget the least recently active users beyond MAX_USERS
+            while len(self.conversation_history) > MAX_USERS:
+                evicted, _ = self.conversation_history.popitem(last=False)
+                self._forget_context(evicted)
+        else:
+            self.conversation_history.move_to_end(user_id)
+        history.append(HistoryEntry(
+            user=user_message,
+            bot=bot_response,
+            tokens=count_tokens(user_message) + count_tokens(bot_response),
+            local=local
+        ))
         
-        # Keep only last 10 exchanges to manage memory
-        if len(self.conversation_history[user_id]) > 10:
-            self.conversation_history[user_id] = self.conversation_history[user_id][-10:]
+        # The exchange that just left the verbatim window waits for the summary,
+        # unless it was small talk or a cached answer (and not at all when OpenAI
+        # keeps the conversation itself). Summaries are made in batches.
+        if not self.enabled or self.use_responses_api or len(history) <= HISTORY_VERBATIM_TURNS:
+            return
+        left = history[-HISTORY_VERBATIM_TURNS - 1]
+        if left.local:
+            return
+        pending = self._pending_summary.setdefault(user_id, [])
+        pending.append(left)
+        # Bound the backlog if summarization keeps failing
+        del pending[:-HISTORY_LIMIT]
+        if len(pending) >= SUMMARY_BATCH and user_id not in self._summary_tasks:
+            self._summary_tasks[user_id] = asyncio.create_task(self._summarize(user_id))
     
-    def _fallback_response(self, message: str) -> str:
-        """Simple fallback responses when LLM is unavailable"""
+    async def _summarize(self, user_id: int):
+        """Fold pending exchanges into the user's rolling summary"""
+        try:
+            while len(self._pending_summary.get(user_id, ())) >= SUMMARY_BATCH:
+                pending = self._pending_summary[user_id]
+                turns = pending[:]
+                parts = []
+                summary = self._summaries.get(user_id)
+                if summary:
+                    parts.append(f"Earlier summary: {summary}")
+                for hist in turns:
+                    parts.append(f"User: {hist.user}\nAssistant: {hist.bot}")
+                
+                payload = {
+                    "model": "gpt-3.5-turbo",
+                    "messages": [
+                        SUMMARY_MESSAGE,
+                        {"role": "user", "content": "\n\n".join(parts)}
+                    ],
+                    "max_tokens": SUMMARY_MAX_TOKENS,
+                    "temperature": 0.3,
+                    "user": self._user_tag(user_id)
+                }
+                response = await self._get_client().post(OPENAI_CHAT_URL, content=_json_dumps(payload), timeout=15.0)
+                if response.status_code != 200:
+                    logger.warning("OpenAI API error while summarizing: %s", response.status_code)
+                    break
+                result = _json_loads(response.content)
+                self._summaries[user_id] = result['choices'][0]['message']['content'].strip()
+                # Only now stop sending these exchanges word for word
+                pending[:] = [hist for hist in pending if hist not in turns]
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning("History summarization failed: %s", e)
+        finally:
+            if self._summary_tasks.get(user_id) is asyncio.current_task():
+                del self._summary_tasks[user_id]
+    
+    def _forget_context(self, user_id: int):
+        """Drop a user's summary and server-side thread, cancelling any summarization in progress"""
+        self._response_ids.pop(user_id, None)
+        self._summaries.pop(user_id, None)
+        self._pending_summary.pop(user_id, None)
+        task = self._summary_tasks.pop(user_id, None)
+        if task is not None:
+            task.cancel()
+    
+    def quick_reply(self, message: str) -> Optional[str]:
+        """Answer short greetings, thanks and goodbyes locally, or return None"""
+        if len(message) > QUICK_REPLY_MAX_LENGTH or "?" in message:
+            return None
+        # Only pure small talk ("hi", "thanks so much", "ok bye"); "hi tell me a joke"
+        # is a real message even though it starts with a greeting
+        tokens = set(_WORD_RE.findall(message.lower()))
+        if not tokens <= _SMALL_TALK_WORDS:
+            return None
+        kind = self._small_talk(message)
+        if kind is not None:
+            return self._fallback_response(message, kind)
+        return None
+    
+    @staticmethod
+    def _small_talk(message: str) -> Optional[str]:
+        """Classify a greeting, thanks or goodbye, or return None"""
         m = message.lower()
+        tokens = set(_WORD_RE.findall(m))
+        if tokens & _GREETING_WORDS:
+            return "greeting"
+        if tokens & _THANKS_WORDS or any(p in m for p in _THANKS_PHRASES):
+            return "thanks"
+        if tokens & _BYE_WORDS or any(p in m for p in _BYE_PHRASES):
+            return "bye"
+        return None
+    
+    def _fallback_response(self, message: str, kind: Optional[str] = None) -> str:
+        """Simple fallback responses when LLM is unavailable"""
+        if kind is None:
+            kind = self._small_talk(message)
         
         # More intelligent fallback responses based on keywords
-        if any(word in m for word in ["hello", "hi", "hey"]):
+        if kind == "greeting":
             return "Hello! Nice to meet you. How can I help you today?"
-        elif any(word in m for word in ["thanks", "thank you"]):
+        elif kind == "thanks":
             return "You're welcome! Is there anything else I can help you with?"
-        elif any(word in m for word in ["bye", "goodbye", "see you"]):
+        elif kind == "bye":
             return "Goodbye! Feel free to message me anytime you need help."
         elif "?" in message:
             return "That's a great question! I'm here to help, though my AI features might be limited right now."
         else:
-            responses = [
-                "I understand. How can I help you with that?",
-                "That's interesting! Tell me more.",
-                "I'm here to help. What would you like to know?",
-                "Thanks for sharing that with me.",
-                "I see. Is there anything specific you'd like assistance with?"
-            ]
-            return responses[hash(message) % len(responses)]
-    
-    def clear_history(self, user_id: str):
+            # Cheap, stable pick: the same message always gets the same reply
+            return _FALLBACK_REPLIES[sum(message.encode()[:16]) % len(_FALLBACK_REPLIES)]
+    
+    def clear_history(self, user_id: int):
         """Clear conversation history for a user"""
         if user_id in self.conversation_history:
             del self.conversation_history[user_id]
+        self._forget_context(user_id)
 
 class TelegramAgentBot:
     """Main Telegram bot class with AI agent capabilities"""
     
     def __init__(self, telegram_token: str):
+        self.llm = LLMProcessor()
+        
         # Build application with better error handling
         try:
-            self.app = Application.builder().token(telegram_token).build()
+            builder = (
+                Application.builder()
+                .token(telegram_token)
+                # Separate, explicitly sized pools so concurrent replies don't
+                # wait on each other or on the long-polling getUpdates request
+                .connection_pool_size(32)
+                .pool_timeout(20)
+                .connect_timeout(10)
+                .read_timeout(30)
+                .get_updates_connection_pool_size(4)
+                .get_updates_pool_timeout(30)
+                .post_init(self._post_init)
+                .post_shutdown(self._post_shutdown)
+            )
+            if RATE_LIMITER_AVAILABLE:
+                # Stay under Telegram's ~30 messages/second bot-wide limit and
+                # retry on 429 instead of failing the reply
+                builder.rate_limiter(AIORateLimiter(overall_max_rate=29, overall_time_period=1, max_retries=3))
+            self.app = builder.build()
         except Exception as e:
-            logger.error(f"Failed to initialize Telegram Application: {e}")
+            logger.error("Failed to initialize Telegram Application: %s", e)
             raise
             
-        self.llm = LLMProcessor()
-        self.user_sessions = {}  # Track user sessions
+        self.user_sessions: "OrderedDict[int, Session]" = OrderedDict()  # Track user sessions, LRU order
+        self._warmup_task: Optional[asyncio.Task] = None
+        # Per-user locks; idle locks are dropped automatically once no handler holds them
+        self._user_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
         
         # Register command handlers
         self.app.add_handler(CommandHandler("start", self.start_command))
         self.app.add_handler(CommandHandler("help", self.help_command))
-        self.app.add_handler(CommandHandler("clear", self.clear_command))
+        self.app.add_handler(CommandHandler("clear", self.clear_command, block=False))  # May wait on the user's lock
         self.app.add_handler(CommandHandler("status", self.status_command))
         
-        # Register message handler for natural conversation
-        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message))
+        # Register message handler for natural conversation; it runs as its own
+        # task so one slow OpenAI reply doesn't hold up other chats' updates
+        # (the per-user lock keeps each user's messages in order)
+        self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message, block=False))
         
-        logger.info(f"Bot initialized with LLM: {'✅ Enabled' if self.llm.enabled else '❌ Disabled'}")
+        logger.info("Bot initialized with LLM: %s", '✅ Enabled' if self.llm.enabled else '❌ Disabled')
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
-        user_name = update.effective_user.first_name or "there"
-        welcome_message = f"""🤖 **AI Agent Bot**
-
-Hello {user_name}! I'm your AI assistant. I can help you with:
-
-✨ **Natural Conversation** - Just talk to me!
-🤔 **Questions & Answers** - Ask me anything
-🛠️ **General Assistance** - I'm here to help
-
-Just send me a message and I'll respond naturally.
-
-Type /help for more commands."""
+        user = update.effective_user
+        welcome_message = WELCOME_MESSAGE.format(user_name=user.first_name or "there")
 
         await update.message.reply_text(welcome_message, parse_mode='Markdown')
         
-        # Initialize user session
-        user_id = str(update.effective_user.id)
-        self.user_sessions[user_id] = {
-            "started_at": datetime.now(),
-            "message_count": 0,
-            "name": update.effective_user.full_name
-        }
+        # Initialize user session; the name is resolved once here, not per message
+        now = time.monotonic()
+        self._store_session(user.id, Session(
+            started_at=now,
+            message_count=0,
+            name=user.full_name,
+            last_seen=now
+        ))
     
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /help command"""
-        help_text = """🆘 **Available Commands:**
-
-🤖 **Natural Chat** - Just type any message!
-• Ask questions, request help, or chat casually
-• I'll understand context from our conversation
-
-📝 **Commands:**
-• `/start` - Initialize the bot
-• `/help` - Show this help message  
-• `/clear` - Clear conversation history
-• `/status` - Show your session info
-
-💡 **Examples:**
-• "What's the weather like?"
-• "Help me write an email"
-• "Tell me a joke"
-• "Explain quantum physics simply"
-
-Just type naturally - I'm designed to understand and help! 🚀"""
-
-        await update.message.reply_text(help_text, parse_mode='Markdown')
+        await update.message.reply_text(HELP_TEXT, parse_mode='Markdown')
     
     async def clear_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /clear command to reset conversation history"""
-        user_id = str(update.effective_user.id)
-        self.llm.clear_history(user_id)
+        user_id = update.effective_user.id
+        # Wait for a reply in progress so it can't write the old exchange back afterwards
+        async with self._lock(user_id):
+            self.llm.clear_history(user_id)
         
         await update.message.reply_text(
             "🧹 **Conversation history cleared!**\n\n"
@@ -281,25 +705,24 @@ Just type naturally - I'm designed to understand and help! 🚀"""
     
     async def status_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /status command to show user session info"""
-        user_id = str(update.effective_user.id)
-        session = self.user_sessions.get(user_id, {})
+        user_id = update.effective_user.id
+        session = self.user_sessions.get(user_id)
         
-        if not session:
+        if session is None:
             await update.message.reply_text("❓ No active session. Use /start to begin!")
             return
         
-        started_at = session.get("started_at", datetime.now())
-        duration = datetime.now() - started_at
-        hours, remainder = divmod(int(duration.total_seconds()), 3600)
+        duration = int(time.monotonic() - session.started_at)
+        hours, remainder = divmod(duration, 3600)
         minutes, _ = divmod(remainder, 60)
         
-        history_count = len(self.llm.conversation_history.get(user_id, []))
+        history_count = len(self.llm.conversation_history.get(user_id, ()))
         
         status_text = f"""📊 **Your Session Status**
 
-👤 **User:** {session.get('name', 'Unknown')}
+👤 **User:** {session.name or 'Unknown'}
 🕒 **Session Duration:** {hours}h {minutes}m
-💬 **Messages Exchanged:** {session.get('message_count', 0)}
+💬 **Messages Exchanged:** {session.message_count}
 🧠 **Conversation Memory:** {history_count} exchanges
 🤖 **AI Status:** {'🟢 Active' if self.llm.enabled else '🔴 Offline'}
 
@@ -310,66 +733,189 @@ Ready to chat! 🚀"""
     async def handle_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle all text messages with AI processing"""
         try:
-            user_id = str(update.effective_user.id)
+            user = update.effective_user
+            user_id = user.id
             user_message = update.message.text
             
-            # Update user session
-            if user_id in self.user_sessions:
-                self.user_sessions[user_id]["message_count"] += 1
+            # Update user session: a counter bump and timestamp, no name lookups
+            now = time.monotonic()
+            self._prune_sessions(now)
+            session = self.user_sessions.get(user_id)
+            if session is not None:
+                session.message_count += 1
+                session.last_seen = now
+                self.user_sessions.move_to_end(user_id)
             else:
                 # Auto-initialize session if not started
-                self.user_sessions[user_id] = {
-                    "started_at": datetime.now(),
-                    "message_count": 1,
-                    "name": update.effective_user.full_name or "User"
-                }
+                self._store_session(user_id, Session(
+                    started_at=now,
+                    message_count=1,
+                    name=user.full_name or "User",
+                    last_seen=now
+                ))
             
-            # Show typing indicator
-            await context.bot.send_chat_action(chat_id=update.effective_chat.id, action="typing")
-            
-            # Analyze message intent
-            analysis = await self.llm.analyze_intent(user_message)
-            
-            # Generate contextual response
-            response = await self.llm.generate_response(
-                user_id, 
-                user_message, 
-                context=f"Intent: {analysis.get('intent', 'unknown')}, Sentiment: {analysis.get('sentiment', 'neutral')}"
+            # Show a typing indicator only if the reply is slow to start; local
+            # and cached answers arrive first and save the extra API call
+            chat_id = update.effective_chat.id
+            typing = asyncio.get_running_loop().call_later(
+                TYPING_DELAY,
+                lambda: context.application.create_task(
+                    context.bot.send_chat_action(chat_id=chat_id, action="typing")
+                )
             )
-            
-            # Send response
-            await update.message.reply_text(response)
+            try:
+                await self._stream_reply(update, context, user_id, user_message, typing)
+            finally:
+                typing.cancel()
             
         except Exception as e:
-            logger.error(f"Error handling message: {e}")
+            logger.error("Error handling message: %s", e)
             await update.message.reply_text(
                 "😅 Sorry, I encountered an issue processing your message. "
                 "Please try again or use /help for available commands."
             )
     
+    def _store_session(self, user_id: int, session: Session):
+        """Save a session as most recently active, evicting the oldest beyond MAX_USERS"""
+        self.user_sessions[user_id] = session
+        self.user_sessions.move_to_end(user_id)
+        while len(self.user_sessions) > MAX_USERS:
+            self.user_sessions.popitem(last=False)
+    
+    def _prune_sessions(self, now: float):
+        """Drop sessions (and their history) idle for longer than SESSION_TTL"""
+        # Sessions are kept in least-recently-active order, so only the front needs checking
+        while self.user_sessions:
+            user_id, session = next(iter(self.user_sessions.items()))
+            if now - session.last_seen <= SESSION_TTL:
+                break
+            del self.user_sessions[user_id]
+            self.llm.clear_history(user_id)
+    
+    def _lock(self, user_id: int) -> asyncio.Lock:
+        """Return the lock serializing this user's turns, creating it if needed"""
+        lock = self._user_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._user_locks[user_id] = lock
+        return lock
+    
+    async def _stream_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                            user_id: int, user_message: str, typing: Optional[asyncio.TimerHandle] = None):
+        """Send the first streamed tokens as a message and edit it as more arrive"""
+        loop = asyncio.get_running_loop()
+        chat_id = update.effective_chat.id
+        sent = None
+        text = ""
+        shown = ""
+        last_edit = 0.0
+        
+        # Serialize turns per user so each reply builds on the previous exchange
+        async with self._lock(user_id):
+            async for delta in self.llm.analyze_and_stream(user_id, user_message):
+                text += delta
+                if sent is None:
+                    if typing is not None:
+                        typing.cancel()
+                    sent = await update.message.reply_text(text)
+                    shown, last_edit = text, loop.time()
+                elif loop.time() - last_edit >= STREAM_EDIT_INTERVAL and text.strip() != shown.strip():
+                    if await self._edit_reply(context, chat_id, sent.message_id, text):
+                        shown = text
+                    last_edit = loop.time()
+            
+            # Final edit carries the complete text
+            if sent is not None and text.strip() != shown.strip():
+                await self._finish_reply(context, chat_id, sent.message_id, text, shown)
+    
+    async def _edit_reply(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int, text: str) -> bool:
+        """Edit a streamed reply, tolerating Telegram rejecting an intermediate edit"""
+        try:
+            await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+            return True
+        except TelegramError as e:
+            logger.debug("Skipped streaming edit: %s", e)
+            return False
+    
+    async def _finish_reply(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, message_id: int,
+                            text: str, shown: str):
+        """Complete a streamed reply, retrying the last edit or sending the rest as a new message"""
+        for _ in range(FINAL_EDIT_ATTEMPTS):
+            try:
+                await context.bot.edit_message_text(text, chat_id=chat_id, message_id=message_id)
+                return
+            except RetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    return
+                # This message can't be edited; deliver the rest separately
+                logger.debug("Final streaming edit rejected: %s", e)
+                break
+            except TelegramError as e:
+                logger.debug("Final streaming edit failed, retrying: %s", e)
+                await asyncio.sleep(1.0)
+        
+        logger.warning("Final streaming edit failed in chat %s; sending the rest as a new message", chat_id)
+        rest = text[len(shown):].strip() if text.startswith(shown) else text
+        try:
+            await context.bot.send_message(chat_id=chat_id, text=rest)
+        except TelegramError as e:
+            logger.warning("Could not deliver the end of a streamed reply to chat %s: %s", chat_id, e)
+    
+    async def _post_init(self, application: Application):
+        """Report the validated bot identity and warm up OpenAI alongside the first poll"""
+        # Application.initialize() has already called getMe, so a bad token fails before this point
+        logger.info("✅ Connected to Telegram as @%s", application.bot.username)
+        self._warmup_task = asyncio.create_task(self.llm.warmup())
+    
+    async def _post_shutdown(self, application: Application):
+        """Release shared resources once the application has stopped"""
+        if self._warmup_task is not None and not self._warmup_task.done():
+            self._warmup_task.cancel()
+        await self.llm.close()
+    
     def run(self):
         """Start the bot with improved error handling"""
         logger.info("🚀 Starting Telegram Agent Bot...")
         
         try:
-            # Use asyncio to run the bot
-            loop = asyncio.new_event_loop()
+            # Use asyncio to run the bot, on uvloop when it is installed
+            loop = uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop()
             asyncio.set_event_loop(loop)
+            logger.info("Event loop: %s.%s", type(loop).__module__, type(loop).__name__)
             
-            # Start polling with error handling
-            self.app.run_polling(
-                drop_pending_updates=True,
-                close_loop=False,
-                stop_signals=None  # Disable signal handling to avoid conflicts
-            )
+            if os.getenv("USE_WEBHOOK") == "1":
+                # Telegram pushes updates to us; the bot token doubles as the secret URL path
+                public_url = os.getenv("PUBLIC_URL", "").rstrip("/")
+                token = self.app.bot.token
+                logger.info("🌐 Receiving updates via webhook at %s/<token>", public_url)
+                self.app.run_webhook(
+                    listen="0.0.0.0",
+                    port=int(os.getenv("PORT", "8443")),
+                    url_path=token,
+                    webhook_url=f"{public_url}/{token}",
+                    secret_token=os.getenv("WEBHOOK_SECRET"),
+                    drop_pending_updates=True,
+                    close_loop=False,
+                    stop_signals=None  # Disable signal handling to avoid conflicts
+                )
+            else:
+                # Start polling with error handling
+                self.app.run_polling(
+                    drop_pending_updates=True,
+                    timeout=30,  # Long-poll: hold each getUpdates open for up to 30s
+                    poll_interval=0.0,
+                    close_loop=False,
+                    stop_signals=None  # Disable signal handling to avoid conflicts
+                )
             
         except KeyboardInterrupt:
             logger.info("👋 Bot stopped by user")
         except Exception as e:
-            logger.error(f"Bot error: {e}")
+            logger.error("Bot error: %s", e)
             # Print more detailed error information
-            import traceback
-            logger.error(f"Detailed error: {traceback.format_exc()}")
+            logger.error("Detailed error", exc_info=True)
             raise
 
 def main():
@@ -387,6 +933,12 @@ def main():
         print("Token should start with bot prefix or be numeric.")
         return 1
     
+    # Webhook mode needs the public HTTPS address Telegram should call
+    if os.getenv("USE_WEBHOOK") == "1" and not os.getenv("PUBLIC_URL"):
+        logger.error("❌ USE_WEBHOOK=1 requires the PUBLIC_URL environment variable!")
+        print("Set PUBLIC_URL to the public HTTPS address of this bot, e.g. https://mybot.example.com")
+        return 1
+    
     # Optional: Check for OpenAI API key
     openai_key = os.getenv("OPENAI_API_KEY")
     if not openai_key:
@@ -402,12 +954,12 @@ def main():
         return 0
         
     except Exception as e:
-        logger.error(f"💥 Failed to start bot: {e}")
+        logger.error("💥 Failed to start bot: %s", e)
         print(f"\nDetailed error: {e}")
         print("\nTroubleshooting tips:")
         print("1. Check your TELEGRAM_BOT_TOKEN is correct")
         print("2. Ensure you have internet connectivity")
-        print("3. Try: pip install --upgrade python-telegram-bot httpx aiohttp")
+        print("3. Try: pip install --upgrade python-telegram-bot \"httpx[http2]\"")
         print("4. Or pin versions: pip install python-telegram-bot==20.7 httpx==0.24.1")
         return 1
 